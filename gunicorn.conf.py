@@ -0,0 +1,10 @@
+# gunicorn settings, picked up automatically by `gunicorn main:app` (see Procfile).
+# For local development use `flask --app main run --debug` instead.
+import os
+
+worker_class = "gthread"
+workers = int(os.environ.get("WEB_CONCURRENCY", 2))
+# main.py sizes its database connection pool from the same variable
+threads = int(os.environ.get("GUNICORN_THREADS", 8))
+# import the app (and its ORM metadata) once in the master and share it with workers
+preload_app = True
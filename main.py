@@ -1,15 +1,21 @@
+import hashlib
+import os
 from datetime import date
 from functools import wraps
 
-from flask import Flask, render_template, redirect, url_for, flash, request, abort
+from argon2 import PasswordHasher
+from argon2.exceptions import InvalidHashError, VerifyMismatchError
+from flask import Flask, render_template, redirect, url_for, flash, request, abort, make_response, session
 from flask_bootstrap import Bootstrap
 from flask_ckeditor import CKEditor
+from flask_compress import Compress
 from flask_gravatar import Gravatar
 from flask_login import UserMixin, login_user, LoginManager, current_user, logout_user
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy import ForeignKey
-from sqlalchemy.orm import relationship
-from werkzeug.security import generate_password_hash, check_password_hash
+from sqlalchemy import ForeignKey, event, func, select
+from sqlalchemy.orm import defer, joinedload, relationship, selectinload
+from sqlalchemy.pool import QueuePool
+from werkzeug.security import check_password_hash
 
 from forms import *
 
@@ -17,12 +23,72 @@ app = Flask(__name__)
 app.config['SECRET_KEY'] = '8BYkEfBA6O6donzWlSihBXox7C0sKR6b'
 ckeditor = CKEditor(app)
 Bootstrap(app)
+# gzip/brotli-compress HTML and text responses for clients that accept it
+app.config['COMPRESS_MIMETYPES'] = ['text/html', 'text/css', 'application/javascript']
+app.config['COMPRESS_LEVEL'] = 5
+Compress(app)
+# registers the "gravatar" Jinja filter used for comment avatars
+gravatar = Gravatar(app,
+                    size=20,
+                    rating='g',
+                    default='retro',
+                    force_default=False,
+                    force_lower=False,
+                    use_ssl=False,
+                    base_url=None)
 
 ##CONNECT TO DB
 app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///blog.db'
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+# keep SQLite connections open between requests instead of reopening the file
+# each time; check_same_thread is off because pooled connections move between threads.
+# One connection per gunicorn worker thread (see gunicorn.conf.py).
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+    "poolclass": QueuePool,
+    "pool_size": int(os.environ.get("GUNICORN_THREADS", 8)),
+    "max_overflow": 2,
+    "pool_pre_ping": True,
+    "pool_recycle": 3600,
+    "connect_args": {"check_same_thread": False},
+}
 db = SQLAlchemy(app)
 
+# Argon2id password hashing - memory-hard, so far costlier to brute force
+# on GPUs than PBKDF2 for the same server-side latency
+password_hasher = PasswordHasher(time_cost=2, memory_cost=64 * 1024, parallelism=2)
+
+
+def hash_password(password):
+    return password_hasher.hash(password)
+
+
+# verified against when there is no real hash to check, so requests for unknown and
+# known emails cost the same and response times don't reveal which accounts exist
+_DUMMY_HASH = hash_password("not-a-real-password")
+
+
+def verify_password(password_hash, password):
+    # accounts created before the switch still hold werkzeug "pbkdf2:" hashes
+    if password_hash.startswith("pbkdf2:"):
+        return check_password_hash(password_hash, password)
+    try:
+        return password_hasher.verify(password_hash, password)
+    except (VerifyMismatchError, InvalidHashError):
+        return False
+
+
+def password_needs_rehash(password_hash):
+    if password_hash.startswith("pbkdf2:"):
+        return True
+    return password_hasher.check_needs_rehash(password_hash)
+
+
+# number of post previews shown per page on the home page
+POSTS_PER_PAGE = 10
+
+# how long browsers/proxies may reuse a page shown to anonymous visitors
+ANONYMOUS_MAX_AGE = 60
+
 # configuring login_manager (Flask authentication)
 login_manager = LoginManager()
 login_manager.init_app(app)
@@ -31,7 +97,11 @@ login_manager.init_app(app)
 # The below function is required to allow authentication feature
 @login_manager.user_loader
 def load_user(user_id):
-    return User.query.get(user_id)
+    return db.session.get(User, int(user_id))
+
+
+# the first registered user is the blog's admin
+ADMIN_ID = 1
 
 
 # admin_only decorator - required to block access to certain routes
@@ -39,8 +109,8 @@ def admin_only(func):
     # imported from functools - mirrored login_required decorator
     @wraps(func)
     def inner(*args, **kwargs):
-        # if user is not admin - return unauthorised messaged using Flask
-        if current_user.id != 1:
+        # if user is not admin (or not logged in at all) - return unauthorised messaged using Flask
+        if not current_user.is_authenticated or current_user.get_id() != str(ADMIN_ID):
             return abort(403)
         return func(*args, **kwargs)
 
@@ -53,13 +123,15 @@ def admin_only(func):
 class User(UserMixin, db.Model):
     __tablename__ = "users"
     id = db.Column(db.Integer, primary_key=True)
-    email = db.Column(db.String(100), unique=True)
+    email = db.Column(db.String(100), unique=True, index=True, nullable=False)
     password = db.Column(db.String(255))
     name = db.Column(db.String(1000))
     # This will act like a List of BlogPost objects attached to each User.
     # The "author" refers to the author property in the BlogPost class.
-    blogposts = relationship("BlogPost", back_populates="author")
-    comments = relationship("Comment", back_populates="author")
+    # Collections load explicitly: anything touching comments must ask for them
+    # with selectinload() instead of silently issuing a query per access.
+    blogposts = relationship("BlogPost", back_populates="author", lazy="select")
+    comments = relationship("Comment", back_populates="author", lazy="raise_on_sql")
 
 
 class BlogPost(db.Model):
@@ -68,41 +140,121 @@ class BlogPost(db.Model):
     author = relationship("User", back_populates="blogposts")
     title = db.Column(db.String(250), unique=True, nullable=False)
     subtitle = db.Column(db.String(250), nullable=False)
-    date = db.Column(db.String(250), nullable=False)
+    date = db.Column(db.Date, nullable=False, default=date.today, index=True)
     body = db.Column(db.Text, nullable=False)
     img_url = db.Column(db.String(250), nullable=False)
-    author_id = db.Column(db.Integer, ForeignKey('users.id'))
-    comments = relationship("Comment", back_populates="parent_post")
+    author_id = db.Column(db.Integer, ForeignKey('users.id'), index=True)
+    # deleting a post deletes its comments - done by the database's ON DELETE CASCADE
+    # rather than by the ORM loading and deleting each comment
+    comments = relationship("Comment", back_populates="parent_post", lazy="raise_on_sql",
+                            cascade="all, delete-orphan", passive_deletes=True)
 
 
 class Comment(db.Model):
     __tablename__ = "comments"
     id = db.Column(db.Integer, primary_key=True)
     text = db.Column(db.Text, nullable=False)
-    author_id = db.Column(db.Integer, ForeignKey('users.id'))
+    author_id = db.Column(db.Integer, ForeignKey('users.id'), index=True)
     author = relationship("User", back_populates="comments")
-    post_id = db.Column(db.Integer, ForeignKey('blog_posts.id'))
-    parent_post = relationship("BlogPost", back_populates="comments")
-    date = db.Column(db.String(250), nullable=False)
-
-
-# required when first creating the tables
+    post_id = db.Column(db.Integer, ForeignKey('blog_posts.id', ondelete="CASCADE"), index=True)
+    # never loaded implicitly - comments are always fetched for a known post
+    parent_post = relationship("BlogPost", back_populates="comments", lazy="raise")
+    date = db.Column(db.Date, nullable=False, default=date.today, index=True)
+
+
+# SQLite tuning - WAL lets readers carry on during writes and NORMAL sync
+# avoids an fsync on every commit. Applied to every new connection.
+def _sqlite_pragmas(dbapi_conn, _):
+    cur = dbapi_conn.cursor()
+    # SQLite ignores foreign keys (and so ON DELETE CASCADE) unless asked
+    cur.execute("PRAGMA foreign_keys=ON")
+    cur.execute("PRAGMA journal_mode=WAL")
+    cur.execute("PRAGMA synchronous=NORMAL")
+    cur.execute("PRAGMA temp_store=MEMORY")
+    cur.execute("PRAGMA cache_size=-20000")
+    cur.close()
+
+
+# required when first creating the tables - create_all won't alter existing ones,
+# so databases made by older versions must be updated with migrate_db.py first
 with app.app_context():
+    # registered before create_all so its connection is tuned as well
+    event.listen(db.engine, "connect", _sqlite_pragmas)
     db.create_all()
+    # don't let forked gunicorn workers inherit the connection create_all opened
+    db.engine.dispose()
 
 
-@app.route('/')
-def get_all_posts():
-    global is_admin
+# exposes logged_in to every template (header.html switches its nav links on it)
+@app.context_processor
+def inject_logged_in():
+    return dict(logged_in=current_user.is_authenticated)
+
+
+# HTTP caching for the public pages - anonymous visitors all see the same HTML,
+# so an ETag built from the data a page shows lets repeat visits get a 304
+# without rendering. Logged-in users get per-user pages, so they are never cached.
+def is_cacheable_request():
+    return not current_user.is_authenticated and request.method == "GET"
 
-    if current_user:
-        logged_in = current_user.is_authenticated
 
+def make_etag(*parts):
+    return hashlib.md5("-".join(str(part) for part in parts).encode()).hexdigest()
+
+
+# returns the If-None-Match tag that matches etag, or None. Flask-Compress sends
+# compressed responses with the ETag suffixed ":gzip"/":br", so the client may
+# hold either form.
+def matching_etag(etag):
+    if etag is None:
+        return None
+    return next((tag for tag in request.if_none_match if tag.split(":", 1)[0] == etag), None)
+
+
+# shared=True lets proxies store the page too; only pass it for pages with no
+# per-visitor content (the post page's comment form carries a session CSRF token)
+def cacheable_response(etag, render, shared=False):
+    matched = matching_etag(etag)
+    if matched is not None:
+        # Flask-Compress leaves a 304 alone, so echo the validator the client cached
+        # (suffix included) - it's what the full response would have carried
+        response = make_response("", 304)
+        response.set_etag(matched)
     else:
-        logged_in = False
+        response = make_response(render())
+        if etag is not None:
+            response.set_etag(etag)
+    if etag is not None:
+        # a page that just set a session cookie must never reach a shared cache
+        if shared and not session.modified:
+            response.cache_control.public = True
+        else:
+            response.cache_control.private = True
+        response.cache_control.max_age = ANONYMOUS_MAX_AGE
+    return response
 
-    posts = BlogPost.query.all()
-    return render_template("index.html", all_posts=posts, logged_in=logged_in)
+
+@app.route('/')
+def get_all_posts():
+    page = request.args.get('page', 1, type=int)
+    # one page of previews, newest first - the large body column is deferred since
+    # previews never show it, and the page's authors come in a single extra IN query
+    pagination = db.paginate(
+        select(BlogPost)
+        .order_by(BlogPost.id.desc())
+        .options(defer(BlogPost.body), selectinload(BlogPost.author)),
+        page=page,
+        per_page=POSTS_PER_PAGE,
+        error_out=False,
+    )
+    etag = None
+    if is_cacheable_request():
+        etag = make_etag(page, pagination.pages,
+                         *((post.id, post.title, post.subtitle, post.img_url, post.date, post.author_id)
+                           for post in pagination.items))
+    return cacheable_response(
+        etag, lambda: render_template("index.html", all_posts=pagination.items, pagination=pagination),
+        shared=True)
 
 
 @app.route('/register', methods=["GET", "POST"])
@@ -117,6 +269,8 @@ def register():
         database_user = User.query.filter_by(email=user_email).first()
 
         if database_user:
+            # costs the same as hashing a new user's password would
+            verify_password(_DUMMY_HASH, user_password)
             flash(
                 message='The email address you have entered already exists in the system. You have been redirected to the login page.',
                 category="error")
@@ -126,7 +280,7 @@ def register():
 
         else:
 
-            hashed_password = generate_password_hash(user_password, "pbkdf2:sha256", 8)
+            hashed_password = hash_password(user_password)
             # creating a new user with the inputted values
             new_user = User(
                 name=user_name,
@@ -139,7 +293,7 @@ def register():
             login_user(new_user)
             return redirect(url_for("get_all_posts", name=new_user.name))
 
-    return render_template("register.html", form=register_form, logged_in=current_user.is_authenticated)
+    return render_template("register.html", form=register_form)
 
 
 @app.route('/login', methods=["GET", "POST"])
@@ -155,7 +309,11 @@ def login():
 
         if database_user:
 
-            if check_password_hash(database_user.password, user_password):
+            if verify_password(database_user.password, user_password):
+                # upgrade legacy PBKDF2 hashes and ones made with older Argon2 parameters
+                if password_needs_rehash(database_user.password):
+                    database_user.password = hash_password(user_password)
+                    db.session.commit()
                 login_user(database_user)
 
                 return redirect(url_for('get_all_posts'))
@@ -165,6 +323,8 @@ def login():
                 flash(message='You have entered an invalid password. Please try again', category="error")
 
         else:
+            # same work as checking a real password
+            verify_password(_DUMMY_HASH, user_password)
             flash(message='The email address you have entered does not exist in the system. Please create an account.',
                   category="error")
 
@@ -180,7 +340,9 @@ def logout():
 
 @app.route("/post/<int:post_id>", methods=["GET", "POST"])
 def show_post(post_id):
-    requested_post = BlogPost.query.get(post_id)
+    requested_post = db.session.get(BlogPost, post_id)
+    if requested_post is None:
+        abort(404)
     comment_form = CommentForm()
 
     if comment_form.validate_on_submit():
@@ -190,7 +352,6 @@ def show_post(post_id):
                 text=comment_form.comment.data,
                 author_id=current_user.id,
                 post_id=post_id,
-                date=date.today().strftime("%B %d, %Y"),
             )
             db.session.add(new_comment)
             db.session.commit()
@@ -200,39 +361,37 @@ def show_post(post_id):
             flash(message='You need to login or register to comment.', category="error")
             return redirect(url_for('login', logged_in=current_user.is_authenticated))
 
-    gravatar = Gravatar(app,
-                        size=20,
-                        rating='g',
-                        default='retro',
-                        force_default=False,
-                        force_lower=False,
-                        use_ssl=False,
-                        base_url=None)
-
-    all_comments = Comment.query.all()[::-1]
-
-    return render_template("post.html", post=requested_post, form=comment_form, comments=all_comments,
-                           gravatar=gravatar, logged_in=current_user.is_authenticated)
+    etag = None
+    if is_cacheable_request():
+        comment_count, last_comment_id = db.session.execute(
+            select(func.count(Comment.id), func.max(Comment.id)).where(Comment.post_id == post_id)
+        ).one()
+        etag = make_etag(requested_post.id, requested_post.title, requested_post.subtitle, requested_post.body,
+                         requested_post.img_url, requested_post.date, requested_post.author_id,
+                         comment_count, last_comment_id)
+
+    def render():
+        # only this post's comments, newest first, with their authors joined in
+        # the same query (a post has few comments, so one JOIN beats two queries)
+        all_comments = db.session.execute(
+            select(Comment)
+            .where(Comment.post_id == post_id)
+            .order_by(Comment.id.desc())
+            .options(joinedload(Comment.author))
+        ).scalars().all()
+        return render_template("post.html", post=requested_post, form=comment_form, comments=all_comments)
+
+    return cacheable_response(etag, render)
 
 
 @app.route("/about")
 def about():
-    if current_user:
-        logged_in = current_user.is_authenticated
-
-    else:
-        logged_in = False
-    return render_template("about.html", logged_in=logged_in)
+    return render_template("about.html")
 
 
 @app.route("/contact")
 def contact():
-    if current_user:
-        logged_in = current_user.is_authenticated
-
-    else:
-        logged_in = False
-    return render_template("contact.html", logged_in=logged_in)
+    return render_template("contact.html")
 
 
 @app.route("/new-post", methods=["GET", "POST"])
@@ -246,7 +405,6 @@ def add_new_post():
             subtitle=form.subtitle.data,
             body=form.body.data,
             img_url=form.img_url.data,
-            date=date.today().strftime("%B %d, %Y"),
             author_id=current_user.id
         )
         db.session.add(new_post)
@@ -258,7 +416,9 @@ def add_new_post():
 @app.route("/edit-post/<int:post_id>")
 @admin_only
 def edit_post(post_id):
-    post = BlogPost.query.get(post_id)
+    post = db.session.get(BlogPost, post_id)
+    if post is None:
+        abort(404)
     edit_form = CreatePostForm(
         title=post.title,
         subtitle=post.subtitle,
@@ -281,15 +441,9 @@ def edit_post(post_id):
 @app.route("/delete/<int:post_id>")
 @admin_only
 def delete_post(post_id):
-    post_to_delete = BlogPost.query.get(post_id)
+    post_to_delete = db.session.get(BlogPost, post_id)
+    if post_to_delete is None:
+        abort(404)
     db.session.delete(post_to_delete)
     db.session.commit()
     return redirect(url_for('get_all_posts'))
-
-
-if __name__ == "__main__":
-    # app.run(host='0.0.0.0', port=5000)
-    app.run(debug=True)
-
-
-# gunicorn vers 20.1.0
\ No newline at end of file
@@ -0,0 +1,121 @@
+# Brings an existing blog.db up to date with the models in main.py.
+# db.create_all() only creates tables that are missing, so a database made by an
+# older version of the app needs its existing tables migrated by hand:
+#
+#     python migrate_db.py [path/to/blog.db]    (defaults to instance/blog.db)
+#
+# Every step checks whether it has already been applied, so re-running is safe.
+# Stop the app (and back up the file) before migrating.
+import sqlite3
+import sys
+from datetime import datetime
+
+DEFAULT_DB = "instance/blog.db"
+
+
+# BlogPost.date and Comment.date used to hold display strings ("December 01, 2022");
+# they are now db.Date columns, which SQLAlchemy stores in SQLite as "2022-12-01"
+def convert_dates(conn):
+    for table in ("blog_posts", "comments"):
+        for row_id, value in conn.execute(f"SELECT id, date FROM {table}").fetchall():
+            try:
+                datetime.strptime(value, "%Y-%m-%d")
+            except ValueError:
+                iso_date = datetime.strptime(value, "%B %d, %Y").date().isoformat()
+                conn.execute(f"UPDATE {table} SET date = ? WHERE id = ?", (iso_date, row_id))
+        conn.execute(f"CREATE INDEX IF NOT EXISTS ix_{table}_date ON {table} (date)")
+
+
+# SQLite can't change a column's constraints in place, so a table is recreated
+# from the new definition and its rows copied across
+# (https://www.sqlite.org/lang_altertable.html#otheralter)
+def rebuild_table(conn, table, create_sql, columns, indexes):
+    conn.execute(create_sql.format(table=f"{table}_new"))
+    column_list = ", ".join(columns)
+    conn.execute(f"INSERT INTO {table}_new ({column_list}) SELECT {column_list} FROM {table}")
+    conn.execute(f"DROP TABLE {table}")
+    conn.execute(f"ALTER TABLE {table}_new RENAME TO {table}")
+    for index in indexes:
+        conn.execute(index)
+
+
+# Comment.post_id is declared ON DELETE CASCADE so deleting a post removes its
+# comments in the database
+def cascade_comment_deletes(conn):
+    foreign_keys = conn.execute("PRAGMA foreign_key_list(comments)").fetchall()
+    if any(fk[2] == "blog_posts" and fk[6] == "CASCADE" for fk in foreign_keys):
+        return
+    rebuild_table(conn, "comments", """
+        CREATE TABLE {table} (
+            id INTEGER NOT NULL,
+            text TEXT NOT NULL,
+            author_id INTEGER,
+            post_id INTEGER,
+            date DATE NOT NULL,
+            PRIMARY KEY (id),
+            FOREIGN KEY(author_id) REFERENCES users (id),
+            FOREIGN KEY(post_id) REFERENCES blog_posts (id) ON DELETE CASCADE
+        )""",
+        ["id", "text", "author_id", "post_id", "date"],
+        [f"CREATE INDEX ix_comments_{column} ON comments ({column})" for column in ("author_id", "post_id", "date")])
+    # with foreign keys now enforced by the app, dangling post/author ids would
+    # make later writes fail - refuse to migrate rather than keep them
+    violations = conn.execute("PRAGMA foreign_key_check(comments)").fetchall()
+    if violations:
+        raise RuntimeError(f"comments rows with missing posts/users (rowid, table, ...): {violations}")
+
+
+# User.email is declared nullable=False and indexed (unique)
+def require_user_email(conn):
+    columns = {row[1]: row for row in conn.execute("PRAGMA table_info(users)")}
+    if columns["email"][3]:
+        return
+    missing = conn.execute("SELECT id FROM users WHERE email IS NULL").fetchall()
+    if missing:
+        raise RuntimeError(f"users without an email (ids): {[row[0] for row in missing]}")
+    rebuild_table(conn, "users", """
+        CREATE TABLE {table} (
+            id INTEGER NOT NULL,
+            email VARCHAR(100) NOT NULL,
+            password VARCHAR(255),
+            name VARCHAR(1000),
+            PRIMARY KEY (id)
+        )""",
+        ["id", "email", "password", "name"],
+        ["CREATE UNIQUE INDEX ix_users_email ON users (email)"])
+
+
+# indexes added to the models for existing tables (comments' and users' are
+# made by their rebuilds)
+def create_indexes(conn):
+    conn.execute("CREATE INDEX IF NOT EXISTS ix_blog_posts_author_id ON blog_posts (author_id)")
+
+
+MIGRATIONS = [
+    convert_dates,
+    cascade_comment_deletes,
+    require_user_email,
+    create_indexes,
+]
+
+
+def migrate(path):
+    # autocommit mode so the explicit BEGIN below also covers the DDL statements
+    conn = sqlite3.connect(path, isolation_level=None)
+    try:
+        # all steps run in one transaction - a failure leaves the file untouched
+        conn.execute("BEGIN")
+        try:
+            for migration in MIGRATIONS:
+                migration(conn)
+                print(f"applied {migration.__name__}")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    migrate(sys.argv[1] if len(sys.argv) > 1 else DEFAULT_DB)